@@ -252,20 +252,14 @@ def is_gauge(monitoring_info_proto):
   return monitoring_info_proto.type in GAUGE_TYPES
 
 
-def _is_user_monitoring_info(monitoring_info_proto):
-  return monitoring_info_proto.urn == USER_COUNTER_URN
-
-
-def _is_user_distribution_monitoring_info(monitoring_info_proto):
-  return monitoring_info_proto.urn == USER_DISTRIBUTION_COUNTER_URN
+_USER_METRIC_URNS = frozenset([USER_COUNTER_URN, USER_DISTRIBUTION_COUNTER_URN])
 
 
 def is_user_monitoring_info(monitoring_info_proto):
   """Returns true if the monitoring info is a user metric."""
-
-  return _is_user_monitoring_info(
-      monitoring_info_proto) or _is_user_distribution_monitoring_info(
-          monitoring_info_proto)
+  # A single set membership test; this runs once per MonitoringInfo when
+  # filtering metrics results.
+  return monitoring_info_proto.urn in _USER_METRIC_URNS
 
 
 def extract_metric_result_map_value(monitoring_info_proto):
@@ -1660,12 +1660,13 @@ class FnApiMetrics(metrics.metric.MetricResults):
     self._monitoring_infos = step_monitoring_infos
 
   def _init_metrics_from_monitoring_infos(self, step_monitoring_infos):
+    is_user_monitoring_info = monitoring_infos.is_user_monitoring_info
     for smi in step_monitoring_infos.values():
-      # Only include user metrics.
+      if self._user_metrics_only:
+        # Only include user metrics.  filter() avoids materializing an
+        # intermediate list of the (possibly very many) monitoring infos.
+        smi = filter(is_user_monitoring_info, smi)
       for mi in smi:
-        if (self._user_metrics_only and
-            not monitoring_infos.is_user_monitoring_info(mi)):
-          continue
         key = self._to_metric_key(mi)
         if monitoring_infos.is_counter(mi):
           self._counters[key] = (
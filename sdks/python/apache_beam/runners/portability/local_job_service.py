@@ -16,7 +16,12 @@
 #
 from __future__ import absolute_import
 
+import atexit
+import collections
+import heapq
+import itertools
 import logging
+import multiprocessing
 import os
 import queue
 import shutil
@@ -30,10 +35,10 @@ from builtins import object
 from concurrent import futures
 
 import grpc
-from google.protobuf import text_format
 
 from apache_beam.portability.api import beam_artifact_api_pb2
 from apache_beam.portability.api import beam_artifact_api_pb2_grpc
+from apache_beam.portability.api import beam_fn_api_pb2
 from apache_beam.portability.api import beam_fn_api_pb2_grpc
 from apache_beam.portability.api import beam_job_api_pb2
 from apache_beam.portability.api import beam_job_api_pb2_grpc
@@ -42,6 +47,21 @@ from apache_beam.portability.api import endpoints_pb2
 from apache_beam.runners.portability import artifact_service
 from apache_beam.runners.portability import fn_api_runner
 
+try:
+  _get_thread_ident = threading.get_ident
+except AttributeError:  # Python 2
+  _get_thread_ident = threading._get_ident
+
+
+def _default_job_service_max_workers():
+  try:
+    cpu_count = multiprocessing.cpu_count()
+  except NotImplementedError:
+    cpu_count = 2
+  return int(
+      os.environ.get('BEAM_JOB_SERVICE_MAX_WORKERS', max(8, 2 * cpu_count)))
+
+
 TERMINAL_STATES = [
     beam_job_api_pb2.JobState.DONE,
     beam_job_api_pb2.JobState.STOPPED,
@@ -49,6 +69,198 @@ TERMINAL_STATES = [
     beam_job_api_pb2.JobState.CANCELLED,
 ]
 
+# Bound on each subscriber queue; beyond this the oldest entries are dropped.
+_MAX_LOG_QUEUE_SIZE = 1024
+
+# Sentinel put on a subscriber queue to wake and terminate its stream.
+_CLOSED = object()
+
+
+def _next_batch(subscriber_queue, max_batch=64, linger_s=0.001):
+  """Blocks for one item, then gathers more until a deadline or max_batch.
+
+  Waiting up to linger_s for the queue to refill amortizes the per-message
+  wakeup and send overhead on chatty streams without adding noticeable
+  latency.  Returns a non-empty list.
+  """
+  batch = [subscriber_queue.get(block=True)]
+  deadline = time.time() + linger_s
+  while len(batch) < max_batch:
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      break
+    try:
+      batch.append(subscriber_queue.get(timeout=remaining))
+    except queue.Empty:
+      break
+  return batch
+
+
+def _merge_messages(msgs):
+  if len(msgs) == 1:
+    return msgs[0]
+  return beam_job_api_pb2.JobMessage(
+      message_id=msgs[0].message_id,
+      time=msgs[0].time,
+      importance=msgs[0].importance,
+      message_text='\n'.join(msg.message_text for msg in msgs))
+
+
+def _coalesce_log_messages(batch):
+  """Merges runs of consecutive JobMessages of equal importance into one.
+
+  Each merged run becomes a single gRPC message on the stream.  State
+  changes (plain ints) and the _CLOSED sentinel are passed through
+  unchanged.
+  """
+  run = []
+  for item in batch:
+    if item is _CLOSED or isinstance(item, int):
+      if run:
+        yield _merge_messages(run)
+        run = []
+      yield item
+    elif run and run[-1].importance == item.importance:
+      run.append(item)
+    else:
+      if run:
+        yield _merge_messages(run)
+      run = [item]
+  if run:
+    yield _merge_messages(run)
+
+
+def _put_nowait_drop_oldest(subscriber_queue, item):
+  """Puts item on subscriber_queue without blocking.
+
+  If the queue is full, the oldest log messages are discarded to make
+  room.  State changes (plain ints) and the _CLOSED sentinel are never
+  dropped: evicted ones are re-enqueued, so they are delivered later than
+  they were published but never lost, keeping stream termination intact
+  for slow subscribers.  Returns the number of log messages dropped.
+  """
+  dropped = 0
+  requeued = 0
+  pending = collections.deque([item])
+  while pending:
+    try:
+      subscriber_queue.put_nowait(pending[0])
+      pending.popleft()
+      continue
+    except queue.Full:
+      pass
+    try:
+      evicted = subscriber_queue.get_nowait()
+    except queue.Empty:
+      continue
+    if ((isinstance(evicted, int) or evicted is _CLOSED) and
+        requeued < subscriber_queue.maxsize):
+      # The requeued cap only matters if the queue somehow holds nothing
+      # but state changes, where preserving them all would cycle forever.
+      pending.appendleft(evicted)
+      requeued += 1
+    else:
+      dropped += 1
+  return dropped
+
+
+class _LogSubscriber(object):
+  """A bounded subscriber queue with a drop-oldest overflow policy."""
+
+  def __init__(self, subscriber_queue):
+    self.queue = subscriber_queue
+    self._dropped = 0
+
+  def put(self, msg):
+    self._dropped += _put_nowait_drop_oldest(self.queue, msg)
+    if self._dropped:
+      notice = beam_job_api_pb2.JobMessage(
+          importance=beam_job_api_pb2.JobMessage.JOB_MESSAGE_WARNING,
+          message_text='%d log messages dropped.' % self._dropped)
+      try:
+        self.queue.put_nowait(notice)
+        self._dropped = 0
+      except queue.Full:
+        pass
+
+
+class JobLogQueues(object):
+  """Fans a stream of JobMessages out to per-subscriber bounded queues.
+
+    A slow subscriber has its oldest messages dropped rather than blocking
+    publication to the other subscribers, so emitting a log never blocks on
+    a stalled gRPC stream.  A bounded cache of the most important messages
+    is kept for subscribers that connect after they were logged.
+    """
+
+  _CACHE_SIZE = 10
+
+  def __init__(self):
+    self._queues = []
+    # Entries are (importance, seq, msg).  While every cached message has
+    # the same importance -- the common steady state -- evicting the least
+    # important message is the same as dropping the oldest, so a bounded
+    # deque gives O(1) puts.  The first time importances diverge the cache
+    # switches to a min-heap with O(log n) eviction.
+    self._cache = collections.deque(maxlen=self._CACHE_SIZE)
+    self._cache_heap = None
+    self._cache_snapshot = ()
+    self._counter = itertools.count()
+    self._lock = threading.Lock()
+
+  def register_dual(self, subscriber_queue, register_state_queue):
+    """Registers subscriber_queue for logs and states in one critical section.
+
+    register_state_queue is called inside the same lock acquisition that
+    adds the log subscription, so no message published in between can reach
+    one registration but not the other.  Returns the cache snapshot from
+    that same critical section, which is exactly the set of messages the
+    subscriber will not receive live.
+    """
+    with self._lock:
+      self._queues.append(_LogSubscriber(subscriber_queue))
+      register_state_queue(subscriber_queue)
+      return self._cache_snapshot
+
+  def remove(self, subscriber_queue):
+    with self._lock:
+      self._queues = [
+          subscriber for subscriber in self._queues
+          if subscriber.queue is not subscriber_queue
+      ]
+
+  def put(self, msg):
+    with self._lock:
+      self._cache_message(msg)
+      if self._cache_heap is None:
+        # The deque is already in logged order.
+        self._cache_snapshot = tuple(entry[2] for entry in self._cache)
+      else:
+        # Present the surviving messages in the order they were logged.
+        self._cache_snapshot = tuple(
+            entry[2] for entry in sorted(
+                self._cache_heap, key=lambda entry: entry[1]))
+      subscribers = list(self._queues)
+    for subscriber in subscribers:
+      subscriber.put(msg)
+
+  def _cache_message(self, msg):
+    # Caller must hold self._lock.  The sequence number breaks importance
+    # ties in favor of evicting the oldest message (and keeps the heap from
+    # ever comparing protos).
+    entry = (msg.importance, next(self._counter), msg)
+    if self._cache_heap is None:
+      if not self._cache or msg.importance == self._cache[0][0]:
+        self._cache.append(entry)
+        return
+      self._cache_heap = list(self._cache)
+      heapq.heapify(self._cache_heap)
+      self._cache = None
+    if len(self._cache_heap) < self._CACHE_SIZE:
+      heapq.heappush(self._cache_heap, entry)
+    else:
+      heapq.heappushpop(self._cache_heap, entry)
+
 
 class LocalJobServicer(beam_job_api_pb2_grpc.JobServiceServicer):
   """Manages one or more pipelines, possibly concurrently.
@@ -64,16 +276,37 @@ class LocalJobServicer(beam_job_api_pb2_grpc.JobServiceServicer):
     subprocesses for the runner and worker(s).
     """
 
-  def __init__(self, staging_dir=None):
+  def __init__(self, staging_dir=None, max_workers=None):
     self._jobs = {}
     self._cleanup_staging_dir = staging_dir is None
     self._staging_dir = staging_dir or tempfile.mkdtemp()
     self._artifact_service = artifact_service.BeamFilesystemArtifactService(
         self._staging_dir)
     self._artifact_staging_endpoint = None
+    # A bounded pool shared by all RPCs, including the long-lived state and
+    # message streams.  An unbounded pool would grow one thread per stream.
+    self._max_workers = max_workers or _default_job_service_max_workers()
+    self._executor = None
+    # Job bodies run on daemon threads gated by this semaphore, bounding
+    # concurrency without blocking interpreter exit: daemon threads are
+    # exempt from the shutdown join, so a still-running job cannot hang
+    # process exit the way executor worker threads would.
+    self._job_semaphore = threading.Semaphore(
+        int(os.environ.get('BEAM_MAX_CONCURRENT_JOBS', 8)))
 
   def start_grpc_server(self, port=0):
-    self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=3))
+    self._executor = futures.ThreadPoolExecutor(
+        max_workers=self._max_workers, thread_name_prefix='beam-job-svc')
+    self._server = grpc.server(
+        self._executor,
+        options=[
+            ('grpc.so_reuseport', 1),
+            ('grpc.max_concurrent_streams', 1024),
+            # The state and message streams carry repetitive text that
+            # compresses well; 2 is gzip (usable on grpcio back to 1.8,
+            # which predates the grpc.Compression API).
+            ('grpc.default_compression_algorithm', 2),
+        ])
     port = self._server.add_insecure_port('localhost:%d' % port)
     beam_job_api_pb2_grpc.add_JobServiceServicer_to_server(self, self._server)
     beam_artifact_api_pb2_grpc.add_ArtifactStagingServiceServicer_to_server(
@@ -85,7 +318,14 @@ class LocalJobServicer(beam_job_api_pb2_grpc.JobServiceServicer):
     return port
 
   def stop(self, timeout=1):
+    # Wake any streams still blocked on a subscriber queue so their
+    # handlers can unregister and finish before the server stops.
+    for job in self._jobs.values():
+      job.close_streams()
     self._server.stop(timeout)
+    if self._executor:
+      self._executor.shutdown(wait=False)
+      self._executor = None
     if os.path.exists(self._staging_dir) and self._cleanup_staging_dir:
       shutil.rmtree(self._staging_dir, ignore_errors=True)
 
@@ -105,7 +345,8 @@ class LocalJobServicer(beam_job_api_pb2_grpc.JobServiceServicer):
         preparation_id,
         request.pipeline_options,
         request.pipeline,
-        provision_info)
+        provision_info,
+        self._job_semaphore)
     logging.debug("Prepared job '%s' as '%s'", request.job_name, preparation_id)
     # TODO(angoenka): Pass an appropriate staging_session_token. The token can
     # be obtained in PutArtifactResponse from JobService
@@ -169,6 +410,44 @@ class LocalJobServicer(beam_job_api_pb2_grpc.JobServiceServicer):
     return beam_job_api_pb2.DescribePipelineOptionsResponse()
 
 
+def _service_descriptor_text(url):
+  """Returns the text-format rendering of an ApiServiceDescriptor with url.
+
+  Equivalent to text_format.MessageToString(
+  ApiServiceDescriptor(url=url), as_one_line=True) but without the
+  reflection walk, as the message is just a single string field.
+  """
+  return 'url: "%s"' % url.replace('\\', '\\\\').replace('"', '\\"')
+
+
+_shared_logging_server_lock = threading.Lock()
+_shared_logging_server = None
+_shared_logging_port = None
+
+
+def _get_shared_logging_port():
+  """Returns the port of the lazily-started shared worker logging server.
+
+  A single server handles the log streams of all subprocess workers;
+  binding and tearing down one server per worker was pure overhead.
+  """
+  global _shared_logging_server, _shared_logging_port
+  with _shared_logging_server_lock:
+    if _shared_logging_server is None:
+      server = grpc.server(
+          futures.ThreadPoolExecutor(
+              max_workers=_default_job_service_max_workers(),
+              thread_name_prefix='beam-worker-log'))
+      port = server.add_insecure_port('[::]:0')
+      beam_fn_api_pb2_grpc.add_BeamFnLoggingServicer_to_server(
+          BeamFnLoggingServicer(), server)
+      server.start()
+      atexit.register(server.stop, 0)
+      _shared_logging_server = server
+      _shared_logging_port = port
+    return _shared_logging_port
+
+
 class SubprocessSdkWorker(object):
   """Manages a SDK worker implemented as a subprocess communicating over grpc.
     """
@@ -176,26 +455,25 @@ class SubprocessSdkWorker(object):
   def __init__(self, worker_command_line, control_address):
     self._worker_command_line = worker_command_line
     self._control_address = control_address
+    # The control descriptor and the environment base are constant for this
+    # worker, so build them once here rather than on every launch.  The
+    # descriptors must stay in protobuf text format, as that is what
+    # sdk_worker_main (and the other SDK harness boot entry points) parse
+    # out of the environment.
+    self._base_env = dict(
+        os.environ,
+        CONTROL_API_SERVICE_DESCRIPTOR=_service_descriptor_text(
+            control_address))
 
   def run(self):
-    logging_server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    logging_port = logging_server.add_insecure_port('[::]:0')
-    logging_server.start()
-    logging_servicer = BeamFnLoggingServicer()
-    beam_fn_api_pb2_grpc.add_BeamFnLoggingServicer_to_server(
-        logging_servicer, logging_server)
-    logging_descriptor = text_format.MessageToString(
-        endpoints_pb2.ApiServiceDescriptor(url='localhost:%s' % logging_port))
-
-    control_descriptor = text_format.MessageToString(
-        endpoints_pb2.ApiServiceDescriptor(url=self._control_address))
+    logging_descriptor = _service_descriptor_text(
+        'localhost:%s' % _get_shared_logging_port())
 
     p = subprocess.Popen(
         self._worker_command_line,
         shell=True,
         env=dict(
-            os.environ,
-            CONTROL_API_SERVICE_DESCRIPTOR=control_descriptor,
+            self._base_env,
             LOGGING_API_SERVICE_DESCRIPTOR=logging_descriptor))
     try:
       p.wait()
@@ -205,30 +483,36 @@ class SubprocessSdkWorker(object):
     finally:
       if p.poll() is None:
         p.kill()
-      logging_server.stop(0)
 
 
-class BeamJob(threading.Thread):
+class BeamJob(object):
   """This class handles running and managing a single pipeline.
 
-    The current state of the pipeline is available as self.state.
+    The job body runs on a daemon thread gated by the servicer's shared
+    semaphore; the current state of the pipeline is available as
+    self.state.
     """
 
   def __init__(self,
                job_id,
                pipeline_options,
                pipeline_proto,
-               provision_info):
-    super(BeamJob, self).__init__()
+               provision_info,
+               job_semaphore):
     self._job_id = job_id
     self._pipeline_options = pipeline_options
     self._pipeline_proto = pipeline_proto
     self._provision_info = provision_info
+    self._job_semaphore = job_semaphore
+    self._run_thread = None
     self._state = None
     self._state_queues = []
-    self._log_queues = []
+    # Immutable snapshot of _state_queues, swapped on (un)subscribe so the
+    # state setter can iterate it without a lock.
+    self._state_queues_snapshot = ()
+    self._subscriber_lock = threading.Lock()
+    self._log_queues = JobLogQueues()
     self.state = beam_job_api_pb2.JobState.STARTING
-    self.daemon = True
 
   @property
   def state(self):
@@ -236,12 +520,26 @@ class BeamJob(threading.Thread):
 
   @state.setter
   def state(self, new_state):
-    # Inform consumers of the new state.
-    for queue in self._state_queues:
-      queue.put(new_state)
+    # Inform consumers of the new state.  State changes must not be dropped,
+    # but older log messages may be discarded to make room on a full queue.
+    # In the common embedded case nobody subscribed and this is a no-op.
+    subscribers = self._state_queues_snapshot
+    if subscribers:
+      for state_queue in subscribers:
+        _put_nowait_drop_oldest(state_queue, new_state)
     self._state = new_state
 
-  def run(self):
+  def start(self):
+    self._run_thread = threading.Thread(target=self._run_gated)
+    # Daemonized so an in-flight job never blocks interpreter shutdown.
+    self._run_thread.daemon = True
+    self._run_thread.start()
+
+  def _run_gated(self):
+    with self._job_semaphore:
+      self._run_job()
+
+  def _run_job(self):
     with JobLogHandler(self._log_queues):
       try:
         fn_api_runner.FnApiRunner(
@@ -261,39 +559,95 @@ class BeamJob(threading.Thread):
       # TODO(robertwb): Actually cancel...
       self.state = beam_job_api_pb2.JobState.CANCELLED
 
+  def close_streams(self):
+    """Wakes and terminates any open state or message streams.
+
+    Message-stream queues are also registered as state queues, so putting
+    the sentinel on every state queue reaches all subscribers.
+    """
+    for state_queue in self._state_queues_snapshot:
+      _put_nowait_drop_oldest(state_queue, _CLOSED)
+
   def get_state_stream(self):
     # Register for any new state changes.
     state_queue = queue.Queue()
-    self._state_queues.append(state_queue)
-
-    yield self.state
-    while True:
-      current_state = state_queue.get(block=True)
-      yield current_state
-      if current_state in TERMINAL_STATES:
-        break
+    self._add_state_queue(state_queue)
+    try:
+      yield self.state
+      while True:
+        for current_state in _next_batch(state_queue):
+          if current_state is _CLOSED:
+            return
+          yield current_state
+          if current_state in TERMINAL_STATES:
+            return
+    finally:
+      self._remove_state_queue(state_queue)
 
   def get_message_stream(self):
     # Register for any new messages.
-    log_queue = queue.Queue()
-    self._log_queues.append(log_queue)
-    self._state_queues.append(log_queue)
-
-    current_state = self.state
-    yield current_state
-    while current_state not in TERMINAL_STATES:
-      msg = log_queue.get(block=True)
-      yield msg
-      if isinstance(msg, int):
-        current_state = msg
+    log_queue = queue.Queue(maxsize=_MAX_LOG_QUEUE_SIZE)
+    cached_messages = self._log_queues.register_dual(
+        log_queue, self._add_state_queue)
+    try:
+      current_state = self.state
+      yield current_state
+      # Replay the most important messages logged before this subscriber
+      # connected.
+      for msg in cached_messages:
+        yield msg
+      while current_state not in TERMINAL_STATES:
+        for msg in _coalesce_log_messages(_next_batch(log_queue)):
+          if msg is _CLOSED:
+            return
+          yield msg
+          if isinstance(msg, int):
+            current_state = msg
+    finally:
+      self._log_queues.remove(log_queue)
+      self._remove_state_queue(log_queue)
+
+  def _add_state_queue(self, state_queue):
+    with self._subscriber_lock:
+      self._state_queues.append(state_queue)
+      self._state_queues_snapshot = tuple(self._state_queues)
+
+  def _remove_state_queue(self, state_queue):
+    with self._subscriber_lock:
+      try:
+        self._state_queues.remove(state_queue)
+      except ValueError:
+        return
+      self._state_queues_snapshot = tuple(self._state_queues)
 
 
 class BeamFnLoggingServicer(beam_fn_api_pb2_grpc.BeamFnLoggingServicer):
 
+  # Mapping from LogEntry levels to logging levels.
+  LOG_LEVEL_MAP = {
+      beam_fn_api_pb2.LogEntry.Severity.CRITICAL: logging.CRITICAL,
+      beam_fn_api_pb2.LogEntry.Severity.ERROR: logging.ERROR,
+      beam_fn_api_pb2.LogEntry.Severity.WARN: logging.WARNING,
+      beam_fn_api_pb2.LogEntry.Severity.NOTICE: logging.INFO + 1,
+      beam_fn_api_pb2.LogEntry.Severity.INFO: logging.INFO,
+      beam_fn_api_pb2.LogEntry.Severity.DEBUG: logging.DEBUG,
+      beam_fn_api_pb2.LogEntry.Severity.TRACE: logging.DEBUG - 1,
+      beam_fn_api_pb2.LogEntry.Severity.UNSPECIFIED: logging.NOTSET,
+  }
+
   def Logging(self, log_bundles, context=None):
+    logger = logging.getLogger()
     for log_bundle in log_bundles:
       for log_entry in log_bundle.log_entries:
-        logging.info('Worker: %s', str(log_entry).replace('\n', ' '))
+        # Check the level before touching the message so that entries below
+        # the threshold cost no string work at all.
+        level = self.LOG_LEVEL_MAP[log_entry.severity]
+        if not logger.isEnabledFor(level):
+          continue
+        text = log_entry.message
+        if log_entry.trace:
+          text = '%s %s' % (text, log_entry.trace)
+        logging.log(level, 'Worker: %s', text.replace('\n', ' '))
     return iter([])
 
 
@@ -315,32 +669,44 @@ class JobLogHandler(logging.Handler):
   def __init__(self, log_queues):
     super(JobLogHandler, self).__init__()
     self._last_id = 0
-    self._logged_thread = None
+    self._logged_thread_ident = None
     self._log_queues = log_queues
+    # Formatted timestamp of the last record, keyed by its whole second;
+    # bursty logging mostly reuses this rather than calling strftime.
+    self._last_sec = -1
+    self._last_time_str = ''
 
   def __enter__(self):
-    # Remember the current thread to demultiplex the logs of concurrently
-    # running pipelines (as Python log handlers are global).
-    self._logged_thread = threading.current_thread()
+    # Remember the current thread's ident to demultiplex the logs of
+    # concurrently running pipelines (as Python log handlers are global).
+    # The ident comparison in emit is a cheap C call, unlike
+    # current_thread() which takes a lock on every record.
+    self._logged_thread_ident = _get_thread_ident()
     logging.getLogger().addHandler(self)
 
   def __exit__(self, *args):
-    self._logged_thread = None
+    self._logged_thread_ident = None
     self.close()
 
   def _next_id(self):
     self._last_id += 1
     return str(self._last_id)
 
+  def _format_time(self, created):
+    sec = int(created)
+    if sec != self._last_sec:
+      self._last_time_str = time.strftime(
+          '%Y-%m-%d %H:%M:%S.', time.localtime(sec))
+      self._last_sec = sec
+    return self._last_time_str
+
   def emit(self, record):
-    if self._logged_thread is threading.current_thread():
+    if self._logged_thread_ident == _get_thread_ident():
       msg = beam_job_api_pb2.JobMessage(
           message_id=self._next_id(),
-          time=time.strftime('%Y-%m-%d %H:%M:%S.',
-                             time.localtime(record.created)),
+          time=self._format_time(record.created),
           importance=self.LOG_LEVEL_MAP[record.levelno],
           message_text=self.format(record))
 
       # Inform all message consumers.
-      for queue in self._log_queues:
-        queue.put(msg)
+      self._log_queues.put(msg)
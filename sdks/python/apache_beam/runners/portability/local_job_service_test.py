@@ -0,0 +1,229 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Test cases for :module:`local_job_service`."""
+
+from __future__ import absolute_import
+
+import queue
+import threading
+import time
+import unittest
+
+from google.protobuf import text_format
+
+from apache_beam.portability.api import beam_job_api_pb2
+from apache_beam.portability.api import endpoints_pb2
+from apache_beam.runners.portability import local_job_service
+
+
+def _message(ix, importance=beam_job_api_pb2.JobMessage.JOB_MESSAGE_BASIC):
+  return beam_job_api_pb2.JobMessage(
+      message_id=str(ix),
+      importance=importance,
+      message_text='message %d' % ix)
+
+
+class PutNowaitDropOldestTest(unittest.TestCase):
+
+  def drain(self, subscriber_queue):
+    items = []
+    while True:
+      try:
+        items.append(subscriber_queue.get_nowait())
+      except queue.Empty:
+        return items
+
+  def test_drops_oldest_log_messages(self):
+    q = queue.Queue(maxsize=3)
+    for ix in range(3):
+      q.put(_message(ix))
+    dropped = local_job_service._put_nowait_drop_oldest(q, _message(3))
+    self.assertEqual(dropped, 1)
+    self.assertEqual(self.drain(q), [_message(1), _message(2), _message(3)])
+
+  def test_never_drops_state_changes(self):
+    q = queue.Queue(maxsize=4)
+    state = beam_job_api_pb2.JobState.RUNNING
+    q.put(state)
+    for ix in range(3):
+      q.put(_message(ix))
+    dropped = local_job_service._put_nowait_drop_oldest(q, _message(3))
+    items = self.drain(q)
+    self.assertEqual(dropped, 1)
+    self.assertIn(state, items)
+    self.assertIn(_message(3), items)
+    self.assertNotIn(_message(0), items)
+
+  def test_never_drops_closed_sentinel(self):
+    q = queue.Queue(maxsize=2)
+    q.put(local_job_service._CLOSED)
+    q.put(_message(0))
+    dropped = local_job_service._put_nowait_drop_oldest(q, _message(1))
+    items = self.drain(q)
+    self.assertEqual(dropped, 1)
+    self.assertIn(local_job_service._CLOSED, items)
+    self.assertEqual([m for m in items if m is not local_job_service._CLOSED],
+                     [_message(1)])
+
+
+class JobLogQueuesTest(unittest.TestCase):
+
+  def cached(self, queues):
+    return list(queues.register_dual(queue.Queue(), lambda _: None))
+
+  def test_cache_uniform_importance_keeps_most_recent(self):
+    queues = local_job_service.JobLogQueues()
+    msgs = [_message(ix) for ix in range(15)]
+    for msg in msgs:
+      queues.put(msg)
+    self.assertEqual(self.cached(queues), msgs[-queues._CACHE_SIZE:])
+    # Uniform importance stays on the O(1) deque path.
+    self.assertIsNone(queues._cache_heap)
+
+  def test_cache_divergent_importance_evicts_least_important(self):
+    queues = local_job_service.JobLogQueues()
+    early = [_message(ix) for ix in range(10)]
+    for msg in early:
+      queues.put(msg)
+    error = _message(
+        10, importance=beam_job_api_pb2.JobMessage.JOB_MESSAGE_ERROR)
+    queues.put(error)
+    late = [_message(ix) for ix in range(11, 20)]
+    for msg in late:
+      queues.put(msg)
+    # The error outlives every basic message logged around it, and the
+    # survivors come back in logged order.
+    self.assertEqual(self.cached(queues), [error] + late)
+    self.assertIsNotNone(queues._cache_heap)
+
+  def test_register_dual_delivers_every_message_exactly_once(self):
+    queues = local_job_service.JobLogQueues()
+    early = [_message(ix) for ix in range(3)]
+    for msg in early:
+      queues.put(msg)
+    state_queues = []
+    log_queue = queue.Queue(maxsize=local_job_service._MAX_LOG_QUEUE_SIZE)
+    cached = queues.register_dual(log_queue, state_queues.append)
+    self.assertEqual(list(cached), early)
+    self.assertEqual(state_queues, [log_queue])
+    late = [_message(ix) for ix in range(3, 6)]
+    for msg in late:
+      queues.put(msg)
+    live = [log_queue.get_nowait() for _ in range(log_queue.qsize())]
+    # Replay covers exactly the pre-registration messages and the live
+    # queue exactly the post-registration ones; nothing is duplicated.
+    self.assertEqual(live, late)
+
+
+class BeamJobStreamTest(unittest.TestCase):
+
+  def make_job(self):
+    return local_job_service.BeamJob(
+        'test-job', None, None, None, threading.Semaphore(1))
+
+  def consume(self, stream, into):
+    thread = threading.Thread(target=lambda: into.extend(stream))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  def wait_for(self, condition):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+      if condition():
+        return
+      time.sleep(0.01)
+    self.fail('Timed out waiting for condition.')
+
+  def assert_finished(self, thread):
+    thread.join(timeout=5)
+    self.assertFalse(thread.is_alive())
+
+  def test_state_stream_ends_on_sentinel_and_unregisters(self):
+    job = self.make_job()
+    received = []
+    thread = self.consume(job.get_state_stream(), received)
+    self.wait_for(lambda: job._state_queues_snapshot)
+    job.close_streams()
+    self.assert_finished(thread)
+    self.assertEqual(received, [beam_job_api_pb2.JobState.STARTING])
+    self.assertEqual(job._state_queues_snapshot, ())
+
+  def test_state_stream_ends_on_terminal_state(self):
+    job = self.make_job()
+    received = []
+    thread = self.consume(job.get_state_stream(), received)
+    self.wait_for(lambda: job._state_queues_snapshot)
+    job.state = beam_job_api_pb2.JobState.DONE
+    self.assert_finished(thread)
+    self.assertEqual(received, [
+        beam_job_api_pb2.JobState.STARTING, beam_job_api_pb2.JobState.DONE
+    ])
+    self.assertEqual(job._state_queues_snapshot, ())
+
+  def test_message_stream_delivers_then_unregisters(self):
+    job = self.make_job()
+    received = []
+    thread = self.consume(job.get_message_stream(), received)
+    self.wait_for(lambda: job._state_queues_snapshot)
+    msg = _message(0)
+    job._log_queues.put(msg)
+    job.state = beam_job_api_pb2.JobState.DONE
+    self.assert_finished(thread)
+    self.assertEqual(received, [
+        beam_job_api_pb2.JobState.STARTING, msg,
+        beam_job_api_pb2.JobState.DONE
+    ])
+    self.assertEqual(job._state_queues_snapshot, ())
+    self.assertEqual(job._log_queues._queues, [])
+
+  def test_message_stream_ends_on_sentinel_and_unregisters(self):
+    job = self.make_job()
+    received = []
+    thread = self.consume(job.get_message_stream(), received)
+    self.wait_for(lambda: job._state_queues_snapshot)
+    job.close_streams()
+    self.assert_finished(thread)
+    self.assertEqual(received, [beam_job_api_pb2.JobState.STARTING])
+    self.assertEqual(job._state_queues_snapshot, ())
+    self.assertEqual(job._log_queues._queues, [])
+
+
+class ServiceDescriptorTextTest(unittest.TestCase):
+
+  def assert_round_trips(self, url):
+    descriptor = endpoints_pb2.ApiServiceDescriptor()
+    text_format.Parse(
+        local_job_service._service_descriptor_text(url), descriptor)
+    self.assertEqual(descriptor, endpoints_pb2.ApiServiceDescriptor(url=url))
+
+  def test_round_trip(self):
+    self.assert_round_trips('localhost:12345')
+
+  def test_round_trip_with_escapes(self):
+    self.assert_round_trips('host "quoted" \\ backslash:0')
+
+  def test_matches_text_format(self):
+    url = 'localhost:12345'
+    self.assertEqual(
+        local_job_service._service_descriptor_text(url),
+        text_format.MessageToString(
+            endpoints_pb2.ApiServiceDescriptor(url=url), as_one_line=True))
+
+
+if __name__ == '__main__':
+  unittest.main()